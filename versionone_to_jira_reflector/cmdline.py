@@ -1,23 +1,58 @@
 import argparse
+import collections
 import logging
 import os
+import sys
 
 from configobj import ConfigObj
 
 from .main import (
     ensure_default_settings,
-    get_versionone_connection,
-    get_jira_connection,
-    get_jira_issue_for_v1_issue,
-    get_versionone_story_by_name,
-    update_jira_ticket_with_versionone_data,
+    get_profile_configs,
     reset_saved_passwords
 )
+from .reflector import Reflector, sync_profiles
 
 
 logger = logging.getLogger(__name__)
 
 
+def get_link_hashes(config):
+    """ Returns the configuration section storing remote link hashes. """
+    if 'link_hashes' not in config:
+        config['link_hashes'] = {}
+    return config['link_hashes']
+
+
+def get_story_numbers_by_profile(versionone_ids, profiles):
+    """ Assigns each supplied VersionOne ID to one or more profiles.
+
+    IDs may be qualified with a profile name (ex: ``retail:B-01234``)
+    to be synchronized using only that profile.  VersionOne story numbers
+    are specific to a single instance, so unqualified IDs are accepted
+    only when exactly one profile is supplied.
+
+    """
+    story_numbers = dict((profile, []) for profile in profiles)
+    for versionone_id in versionone_ids:
+        if ':' in versionone_id:
+            profile, story_number = versionone_id.split(':', 1)
+            if profile not in story_numbers:
+                raise ValueError(
+                    "Unknown or unselected profile '%s'." % profile
+                )
+            story_numbers[profile].append(story_number)
+        elif len(profiles) == 1:
+            story_numbers[list(profiles)[0]].append(versionone_id)
+        else:
+            raise ValueError(
+                "'%s' must be prefixed with a profile name "
+                "(ex: profile:%s) when more than one profile is "
+                "selected." % (versionone_id, versionone_id)
+            )
+    return story_numbers
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -25,8 +60,22 @@ def main():
         type=str,
         nargs='+',
         help=(
-            'A list of VersionOne IDs for which to'
-            'create/update JIRA tickets.'
+            'A list of VersionOne IDs for which to '
+            'create/update JIRA tickets.  When more than one profile '
+            'is selected, each ID must be prefixed with the name of the '
+            'profile to synchronize it with (ex: retail:B-01234).'
+        )
+    )
+    parser.add_argument(
+        '--profile',
+        dest='profiles',
+        type=str,
+        action='append',
+        default=argparse.SUPPRESS,
+        help=(
+            'Named profile from the configuration file to synchronize; '
+            'may be given more than once.  By default, all configured '
+            'profiles are used.'
         )
     )
     parser.add_argument(
@@ -54,6 +103,16 @@ def main():
             'Reset saved passwords.'
         )
     )
+    parser.add_argument(
+        '--refresh-links',
+        default=False,
+        action='store_true',
+        help=(
+            'Check every ticket\'s links against VersionOne, even if the '
+            'story\'s links have not changed since they were last '
+            'synchronized.'
+        )
+    )
     parser.add_argument(
         '--loglevel',
         type=str,
@@ -88,30 +147,83 @@ def main():
         ConfigObj(args.configfile)
     )
 
-    if args.reset_saved_passwords:
-        reset_saved_passwords(config)
+    labels = args.labels if 'labels' in args else None
+    profiles = get_profile_configs(config)
+    if 'profiles' in args:
+        unknown = set(args.profiles) - set(profiles)
+        if unknown:
+            parser.error(
+                'Unknown profile(s): %s' % ', '.join(sorted(unknown))
+            )
+        profiles = collections.OrderedDict(
+            (name, profile_config)
+            for name, profile_config in profiles.items()
+            if name in args.profiles
+        )
 
-    v1_connection = get_versionone_connection(config)
-    jira_connection = get_jira_connection(config)
+    if not profiles:
+        if args.reset_saved_passwords:
+            reset_saved_passwords(config)
 
-    for story_number in args.versionone_ids:
-        logger.info("Processing story #%s", story_number)
-        story = get_versionone_story_by_name(
-            v1_connection, config, story_number
+        reflector = Reflector(
+            config,
+            labels=labels,
+            open_url=not args.no_open,
+            interactive=True,
+            link_hashes=get_link_hashes(config),
+            refresh_links=args.refresh_links,
         )
-        ticket = get_jira_issue_for_v1_issue(
-            jira_connection, config, story
+        failed = any(
+            result.error for result in reflector.sync(args.versionone_ids)
         )
+    else:
+        try:
+            story_numbers = get_story_numbers_by_profile(
+                args.versionone_ids, profiles
+            )
+        except ValueError as e:
+            parser.error(str(e))
 
-        update_jira_ticket_with_versionone_data(
-            jira_connection,
-            v1_connection,
-            ticket,
-            story,
-            config,
-            args.labels if 'labels' in args else None,
-            open_url=not args.no_open
-        )
+        # Profiles are processed concurrently; rather than asking
+        # which project each new issue belongs in, use the profile's
+        # configured project.
+        unconfigured = [
+            name for name in profiles
+            if story_numbers[name]
+            and not profiles[name]['jira'].get('project')
+        ]
+        if unconfigured:
+            parser.error(
+                'No JIRA project is configured for profile(s): %s; '
+                'set jira.project for each in %s.' % (
+                    ', '.join(unconfigured),
+                    args.configfile,
+                )
+            )
+
+        work = []
+        for name, profile_config in profiles.items():
+            if args.reset_saved_passwords:
+                reset_saved_passwords(profile_config, profile=name)
+            if not story_numbers[name]:
+                continue
+            reflector = Reflector(
+                profile_config,
+                labels=labels,
+                open_url=not args.no_open,
+                project=profile_config['jira'].get('project'),
+                profile=name,
+                link_hashes=get_link_hashes(profile_config),
+                refresh_links=args.refresh_links,
+            )
+            work.append((reflector, story_numbers[name]))
+
+        report = sync_profiles(work)
+        report.log_summary()
+        failed = bool(report.errors)
 
     # If any configuration values were changed, let's save them
     config.write()
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,223 @@
+import functools
+import hashlib
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+
+
+logger = logging.getLogger(__name__)
+
+
+BACKREFERENCE_NAME = 'VersionOne Story'
+GLOBAL_ID_PREFIX = 'versionone='
+MUTATION_CONCURRENCY = 8
+
+
+def get_global_id(asset):
+    """ Returns the JIRA remote link ``globalId`` for a VersionOne asset.
+
+    JIRA treats a remote link posted with a ``globalId`` matching an
+    existing link on the same issue as an update of that link, so using
+    a stable identifier lets us change a link's title or URL in place.
+
+    """
+    return GLOBAL_ID_PREFIX + asset.idref
+
+
+def get_desired_links(story):
+    """ Returns the remote links a story's JIRA ticket should have. """
+    desired = [
+        {
+            'globalId': get_global_id(link),
+            'title': link.Name,
+            'url': link.URL,
+        }
+        for link in story.Links
+    ]
+    desired.append({
+        'globalId': get_global_id(story),
+        'title': BACKREFERENCE_NAME,
+        'url': story.url,
+    })
+    return desired
+
+
+def get_links_hash(links):
+    """ Returns a hash identifying a set of desired links. """
+    serialized = json.dumps(
+        sorted(
+            [link['globalId'], link['title'], link['url']]
+            for link in links
+        )
+    )
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+
+def get_link_mutations(jira, ticket, desired):
+    """ Compares ``desired`` links against those on ``ticket``.
+
+    Returns a list of zero-argument callables that, when run, will
+    bring the ticket's remote links in line with ``desired``:
+
+    * Links we've created before are matched by ``globalId``; if their
+      title or URL has changed, they're updated in place.
+    * Links without a ``globalId`` are matched by title and URL, and
+      left alone if both match.
+    * Otherwise, a link without a ``globalId`` whose title matches a
+      desired link is taken over: its URL is updated in place and it
+      is given a ``globalId``.  Earlier versions matched links by title
+      alone and did not set a ``globalId``, so links they created can't
+      be told apart from links added by hand that share a title; such
+      links are treated as ours, just as they were before, and will be
+      deleted if their VersionOne link is later removed.
+    * Links we've created that are no longer on the story are deleted.
+    * Remaining desired links are created.
+
+    Links without a ``globalId`` whose title matches no desired link,
+    and links with another application's ``globalId``, are never
+    touched.
+
+    """
+    by_global_id = {}
+    unowned = []
+    for link in jira.remote_links(ticket):
+        global_id = link.raw.get('globalId') or ''
+        if global_id.startswith(GLOBAL_ID_PREFIX):
+            by_global_id[global_id] = link
+        else:
+            unowned.append(link)
+
+    mutations = []
+    unmatched = []
+    for wanted in desired:
+        existing = by_global_id.pop(wanted['globalId'], None)
+        if existing is None:
+            unmatched.append(wanted)
+        elif (
+            existing.object.title != wanted['title']
+            or existing.object.url != wanted['url']
+        ):
+            mutations.append(_upsert(jira, ticket, wanted))
+
+    # Links without a globalId; prefer exact matches so that links
+    # sharing a title are paired with the right counterpart.
+    remaining = []
+    for wanted in unmatched:
+        for link in unowned:
+            if (
+                link.object.title == wanted['title']
+                and link.object.url == wanted['url']
+            ):
+                unowned.remove(link)
+                break
+        else:
+            remaining.append(wanted)
+
+    # Links sharing only a title may have been created by an earlier
+    # version (which matched on title alone); adopt them.
+    for wanted in remaining:
+        for link in unowned:
+            if link.object.title == wanted['title']:
+                unowned.remove(link)
+                mutations.append(_update(link, wanted))
+                break
+        else:
+            mutations.append(_upsert(jira, ticket, wanted))
+
+    for link in by_global_id.values():
+        mutations.append(link.delete)
+
+    return mutations
+
+
+def _upsert(jira, ticket, wanted):
+    def mutation():
+        jira.add_remote_link(
+            issue=ticket,
+            destination={
+                'url': wanted['url'],
+                'title': wanted['title'],
+            },
+            globalId=wanted['globalId'],
+        )
+    return mutation
+
+
+def _update(link, wanted):
+    def mutation():
+        link.update(
+            globalId=wanted['globalId'],
+            object={
+                'url': wanted['url'],
+                'title': wanted['title'],
+            },
+        )
+    return mutation
+
+
+def _run_mutation(ticket, mutation):
+    try:
+        mutation()
+    except Exception as e:
+        logger.exception('Unable to update a remote link on %s', ticket)
+        return e
+    return None
+
+
+def sync_remote_links(
+    jira, ticket, story, link_hashes=None, refresh_links=False,
+):
+    """ Bring ``ticket``'s remote links in line with ``story``'s links.
+
+    If ``link_hashes`` (a dictionary keyed by ticket key) is supplied,
+    it is used to skip fetching the ticket's links entirely when the
+    story's links have not changed since they were last synchronized;
+    it is updated after a successful synchronization.  Set
+    ``refresh_links`` to check the ticket's links even if they appear
+    to be unchanged.
+
+    Mutations are independent of one another and are run concurrently
+    using ``jira``'s session.  The session's state is only read while
+    making requests (credentials and headers are set once, when the
+    client is created, and its cookie jar does its own locking), and
+    requests' connection pool is itself thread-safe; at most
+    ``MUTATION_CONCURRENCY`` requests are made at once so that the pool's
+    default limit of 10 connections per host is not exceeded.  Profiles
+    each have their own client, so concurrent profiles share nothing.
+    Every failed mutation is logged; the first failure is then raised.
+
+    """
+    desired = get_desired_links(story)
+    links_hash = get_links_hash(desired)
+    if (
+        not refresh_links
+        and link_hashes is not None
+        and link_hashes.get(ticket.key) == links_hash
+    ):
+        logger.debug('Links for %s are unchanged; skipping.', ticket)
+        return
+
+    mutations = get_link_mutations(jira, ticket, desired)
+    logger.debug(
+        'Applying %s remote link change(s) to %s', len(mutations), ticket
+    )
+    if len(mutations) == 1:
+        errors = [_run_mutation(ticket, mutations[0])]
+    elif mutations:
+        pool = ThreadPool(min(len(mutations), MUTATION_CONCURRENCY))
+        try:
+            errors = pool.map(
+                functools.partial(_run_mutation, ticket), mutations
+            )
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        errors = []
+
+    errors = [error for error in errors if error is not None]
+    if errors:
+        raise errors[0]
+
+    if link_hashes is not None:
+        link_hashes[ticket.key] = links_hash
@@ -1,5 +1,7 @@
+import collections
 import getpass
 import logging
+import threading
 import webbrowser
 
 from html2text import html2text
@@ -11,6 +13,7 @@ from verlib import NormalizedVersion
 
 from .exceptions import ConfigurationError, NotFound
 from .jira_client import JIRA
+from .links import sync_remote_links
 from .util import response_was_yes
 from . import __version__
 
@@ -45,13 +48,29 @@ DEFAULT_SETTINGS = {
         'labels_field_label': 'Labels',
     },
 }
-BACKREFERENCE_NAME = 'VersionOne Story'
+PROMPT_LOCK = threading.RLock()
 
 
 logger = logging.getLogger(__name__)
 
 
-def ensure_default_settings(config):
+def ensure_default_settings(config, upgrade=True):
+    """ Fills in missing settings with their defaults.
+
+    If ``upgrade`` is set and ``config`` was written by an older version,
+    existing settings are also reset to their defaults and ``config`` is
+    marked as being written by this version.
+
+    """
+    if not upgrade:
+        for section, values in DEFAULT_SETTINGS.items():
+            if section not in config:
+                config[section] = {}
+            for key, value in values.items():
+                if key not in config[section]:
+                    config[section][key] = value
+        return config
+
     version = NormalizedVersion(__version__)
     if 'version' in config:
         config_version = NormalizedVersion(config['version'])
@@ -69,11 +88,72 @@ def ensure_default_settings(config):
     return config
 
 
-def reset_saved_passwords(config):
+def get_profile_configs(config):
+    """ Returns the configuration for each named profile.
+
+    Each profile is a sub-section of the ``[profiles]`` section, and is
+    laid out exactly like a stand-alone configuration file::
+
+        [profiles]
+            [[retail]]
+                [[[versionone]]]
+                instance_url = https://www.v1host.com/Retail/
+                story_types = Story,Defect
+                [[[jira]]]
+                domain = https://jira.retail.mycompany.com/
+                project = RET
+            [[wholesale]]
+                [[[versionone]]]
+                instance_url = https://www.v1host.com/Wholesale/
+                story_types = Story
+                [[[jira]]]
+                domain = https://jira.wholesale.mycompany.com/
+                project = WHO
+
+    Missing settings are filled-in with their defaults for each profile
+    individually.  Unlike the top-level configuration, settings a profile
+    overrides (like ``story_types`` above) are never reset to their
+    defaults when upgrading to a new version.  Profiles are returned in
+    the order in which they are defined; if no profiles are defined, an
+    empty dictionary is returned.
+
+    """
+    profiles = collections.OrderedDict()
+    if 'profiles' not in config:
+        return profiles
+
+    for name in config['profiles'].sections:
+        profiles[name] = ensure_default_settings(
+            config['profiles'][name], upgrade=False
+        )
+    return profiles
+
+
+def get_keyring_username(service, profile=None):
+    """ Returns the keyring username under which to store a password.
+
+    Passwords for the default (unnamed) configuration are stored under
+    the service name alone (``versionone`` or ``jira``) so that existing
+    saved passwords continue to work; passwords for named profiles are
+    stored separately for each profile.
+
+    """
+    if profile:
+        return '%s:%s' % (profile, service)
+    return service
+
+
+def get_prompt_prefix(profile=None):
+    if profile:
+        return '[%s] ' % profile
+    return ''
+
+
+def reset_saved_passwords(config, profile=None):
     try:
         keyring.delete_password(
             'versionone_to_jira_reflector',
-            'versionone'
+            get_keyring_username('versionone', profile),
         )
     except keyring.errors.PasswordDeleteError:
         logger.warning(
@@ -82,7 +162,7 @@ def reset_saved_passwords(config):
     try:
         keyring.delete_password(
             'versionone_to_jira_reflector',
-            'jira'
+            get_keyring_username('jira', profile),
         )
     except keyring.errors.PasswordDeleteError:
         logger.warning(
@@ -90,47 +170,58 @@ def reset_saved_passwords(config):
         )
 
 
-def get_versionone_connection(config):
+def get_versionone_connection(config, profile=None):
     settings_saved = True
     v1_use_token = config['versionone'].get('auth_type') == 'token',
+    prefix = get_prompt_prefix(profile)
+    keyring_username = get_keyring_username('versionone', profile)
+
+    # Profiles may be connected concurrently; make sure that we're
+    # only ever asking the user one question at a time.
+    with PROMPT_LOCK:
+        username = config['versionone'].get('username')
+        if not username:
+            settings_saved = False
+            username = input(prefix + 'VersionOne Username: ')
+
+        url = config['versionone'].get('instance_url')
+        if not url:
+            settings_saved = False
+            url = input(
+                prefix + 'VersionOne Instance URL '
+                '(ex: http://www.v1host.com/MyInstance100/): '
+            )
 
-    username = config['versionone'].get('username')
-    if not username:
-        settings_saved = False
-        username = input('VersionOne Username: ')
-
-    url = config['versionone'].get('instance_url')
-    if not url:
-        settings_saved = False
-        url = input(
-            'VersionOne Instance URL '
-            '(ex: http://www.v1host.com/MyInstance100/): '
-        )
-
-    if not settings_saved:
-        save = input('Save VersionOne username and instance URL? (N/y): ')
-        if response_was_yes(save):
-            config['versionone']['username'] = username
-            config['versionone']['instance_url'] = url
+        if not settings_saved:
+            save = input(
+                prefix +
+                'Save VersionOne username and instance URL? (N/y): '
+            )
+            if response_was_yes(save):
+                config['versionone']['username'] = username
+                config['versionone']['instance_url'] = url
 
-    password = keyring.get_password(
-        'versionone_to_jira_reflector',
-        'versionone',
-    )
-    if not password:
-        if v1_use_token:
-            password = getpass.getpass(
-                'VersionOne Token (Click your picture -> Applictions to '
-                'generate a personal access token called v1tojira): ')
-        else:
-            password = getpass.getpass('VersionOne Password: ')
-        save = input('Save VersionOne password to system keychain? (N/y): ')
-        if response_was_yes(save):
-            keyring.set_password(
-                'versionone_to_jira_reflector',
-                'versionone',
-                password,
+        password = keyring.get_password(
+            'versionone_to_jira_reflector',
+            keyring_username,
+        )
+        if not password:
+            if v1_use_token:
+                password = getpass.getpass(
+                    prefix + 'VersionOne Token (Click your picture -> '
+                    'Applictions to generate a personal access token '
+                    'called v1tojira): ')
+            else:
+                password = getpass.getpass(prefix + 'VersionOne Password: ')
+            save = input(
+                prefix + 'Save VersionOne password to system keychain? (N/y): '
             )
+            if response_was_yes(save):
+                keyring.set_password(
+                    'versionone_to_jira_reflector',
+                    keyring_username,
+                    password,
+                )
 
     parsed_address = parse.urlparse(url)
     address = parsed_address.netloc
@@ -162,58 +253,65 @@ def get_versionone_connection(config):
     return connection
 
 
-def get_jira_connection(config):
+def get_jira_connection(config, profile=None):
     settings_saved = True
+    prefix = get_prompt_prefix(profile)
+    keyring_username = get_keyring_username('jira', profile)
+
+    with PROMPT_LOCK:
+        username = config['jira'].get('username')
+        if not username:
+            settings_saved = False
+            username = input(prefix + 'JIRA Username: ')
+
+        domain = config['jira'].get('domain')
+        if not domain:
+            settings_saved = False
+            domain = input(
+                prefix + 'JIRA Domain '
+                '(ex: https://jira.mycompany.com/): '
+            )
 
-    username = config['jira'].get('username')
-    if not username:
-        settings_saved = False
-        username = input('JIRA Username: ')
-
-    domain = config['jira'].get('domain')
-    if not domain:
-        settings_saved = False
-        domain = input(
-            'JIRA Domain '
-            '(ex: https://jira.mycompany.com/): '
-        )
-
-    parsed_address = parse.urlparse(domain)
-    if parsed_address.scheme == 'http':
-        logger.warning(
-            "You entered an HTTP URL rather than HTTPS; if you encounter "
-            "problems updating JIRA issues, you may want to edit your "
-            "local configuration file and change the JIRA server settings to "
-            "use HTTPS."
-        )
+        parsed_address = parse.urlparse(domain)
+        if parsed_address.scheme == 'http':
+            logger.warning(
+                "You entered an HTTP URL rather than HTTPS; if you encounter "
+                "problems updating JIRA issues, you may want to edit your "
+                "local configuration file and change the JIRA server "
+                "settings to use HTTPS."
+            )
 
-    project = config['jira'].get('project')
-    if not project:
-        settings_saved = False
-        project = input(
-            'Default JIRA project for new issues: '
-        )
+        project = config['jira'].get('project')
+        if not project:
+            settings_saved = False
+            project = input(
+                prefix + 'Default JIRA project for new issues: '
+            )
 
-    if not settings_saved:
-        save = input('Save JIRA username, domain, and project? (N/y): ')
-        if response_was_yes(save):
-            config['jira']['username'] = username
-            config['jira']['domain'] = domain
-            config['jira']['project'] = project
+        if not settings_saved:
+            save = input(
+                prefix + 'Save JIRA username, domain, and project? (N/y): '
+            )
+            if response_was_yes(save):
+                config['jira']['username'] = username
+                config['jira']['domain'] = domain
+                config['jira']['project'] = project
 
-    password = keyring.get_password(
-        'versionone_to_jira_reflector',
-        'jira',
-    )
-    if not password:
-        password = getpass.getpass('JIRA Password: ')
-        save = input('Save JIRA password to system keychain? (N/y): ')
-        if response_was_yes(save):
-            keyring.set_password(
-                'versionone_to_jira_reflector',
-                'jira',
-                password
+        password = keyring.get_password(
+            'versionone_to_jira_reflector',
+            keyring_username,
+        )
+        if not password:
+            password = getpass.getpass(prefix + 'JIRA Password: ')
+            save = input(
+                prefix + 'Save JIRA password to system keychain? (N/y): '
             )
+            if response_was_yes(save):
+                keyring.set_password(
+                    'versionone_to_jira_reflector',
+                    keyring_username,
+                    password
+                )
 
     logger.debug(
         'Connecting to JIRA with the following params: '
@@ -229,7 +327,7 @@ def get_jira_connection(config):
     )
 
 
-def get_jira_field_name_by_label(jira_connection, label):
+def get_jira_field_name_by_label(jira_connection, label, fields=None):
     """ Returns the field name using a label assigned to a custom field.
 
     Custom fields are not stored in JIRA under their label name; this
@@ -238,10 +336,15 @@ def get_jira_field_name_by_label(jira_connection, label):
     returns the actual field name.  If a match is not found, this function
     returns None.
 
+    If ``fields`` (a list of fields as returned by JIRA) is supplied, it
+    is searched instead of querying the jira API.
+
     """
+    if fields is None:
+        fields = jira_connection.fields()
     matching_fields = [
         f['id']
-        for f in jira_connection.fields()
+        for f in fields
         if label.lower() in f['name'].lower()
     ]
     if matching_fields:
@@ -249,6 +352,29 @@ def get_jira_field_name_by_label(jira_connection, label):
     return None
 
 
+def get_jira_field_names(jira_connection, config):
+    """ Returns the JIRA field names for each of our custom field labels.
+
+    Looking up a field by label requires fetching the full list of fields
+    from JIRA, so this function fetches that list only once and resolves
+    all of the labels we care about against it.  The returned dictionary
+    is keyed by ``code_review``, ``feature_branch`` and ``labels``.
+
+    """
+    fields = jira_connection.fields()
+    labels = {
+        'code_review': config['jira']['code_review_field_label'],
+        'feature_branch': config['jira']['feature_branch_field_label'],
+        'labels': config['jira']['labels_field_label'],
+    }
+    field_names = {}
+    for key, label in labels.items():
+        field_names[key] = get_jira_field_name_by_label(
+            jira_connection, label, fields=fields
+        )
+    return field_names
+
+
 def get_jira_issue_for_v1_issue(jira_connection, config, story):
     """ Returns a JIRA issue matching this story (or None). """
     standardized = get_standardized_versionone_data_for_story(story, config)
@@ -388,8 +514,18 @@ def get_standardized_versionone_data_for_story(story, config):
 
 def update_jira_ticket_with_versionone_data(
     jira, v1, ticket, story, config, labels,
-    open_url=False,
+    open_url=False, field_names=None, project=None, link_hashes=None,
+    refresh_links=False,
 ):
+    """ Create or update ``ticket`` so that it matches ``story``.
+
+    If ``field_names`` (as returned by ``get_jira_field_names``) is not
+    supplied, custom field names will be looked up from JIRA.  If
+    ``project`` is not supplied, the user will be asked which project
+    to create new issues in.  See ``sync_remote_links`` for
+    ``link_hashes`` and ``refresh_links``.
+
+    """
     standardized = get_standardized_versionone_data_for_story(story, config)
     html_description = 'No description provided'
     if standardized['description']:
@@ -404,21 +540,14 @@ def update_jira_ticket_with_versionone_data(
     }
 
     # Custom fields cannot be set on create!
-    code_review_field_name = get_jira_field_name_by_label(
-        jira, config['jira']['code_review_field_label']
-    )
-    feature_branch_field_name = get_jira_field_name_by_label(
-        jira, config['jira']['feature_branch_field_label']
-    )
-    labels_field_name = get_jira_field_name_by_label(
-        jira, config['jira']['labels_field_label']
-    )
+    if field_names is None:
+        field_names = get_jira_field_names(jira, config)
     update_params = {
-        code_review_field_name: standardized['code_review_url'],
-        feature_branch_field_name: standardized['number'],
+        field_names['code_review']: standardized['code_review_url'],
+        field_names['feature_branch']: standardized['number'],
     }
     if labels:
-        update_params['fields'] = {labels_field_name: labels}
+        update_params['fields'] = {field_names['labels']: labels}
 
     if ticket:
         logger.debug('Updating issue %s', ticket)
@@ -435,10 +564,12 @@ def update_jira_ticket_with_versionone_data(
                 'name': config['jira']['username']
             }
         })
-        default_project = config['jira']['project']
-        project = input('JIRA project [' + default_project + ']: ')
         if not project:
-            project = default_project
+            default_project = config['jira']['project']
+            with PROMPT_LOCK:
+                project = input('JIRA project [' + default_project + ']: ')
+            if not project:
+                project = default_project
         base_params['project'] = {
             'key': project
         }
@@ -448,42 +579,11 @@ def update_jira_ticket_with_versionone_data(
         ticket.update(**update_params)
         logger.debug('Created issue %s', ticket)
 
-    # Update links
-    # 1. Fetch links from JIRA
-    # 2. Loop through links from V1
-    #    a. If the link exists, but does not match -- delete it.
-    #    b. If the link does not exist (including if we deleted it
-    #       above), create it.
-    jira_links = {}
-    for link in jira.remote_links(ticket):
-        jira_links[link.object.title] = link
-        # link.object.url
-
-    for link in story.Links:
-        if (
-            link.Name in jira_links
-            and link.URL != jira_links[link.Name].object.url
-        ):
-            jira_links[link.Name].delete()
-            del jira_links[link.Name]
-        # Do *not* make into an elif -- we might have deleted it above
-        if link.Name not in jira_links:
-            jira.add_remote_link(
-                issue=ticket,
-                destination={
-                    'url': link.URL,
-                    'title': link.Name,
-                }
-            )
-
-    if BACKREFERENCE_NAME not in jira_links:
-        jira.add_remote_link(
-            issue=ticket,
-            destination={
-                'url': story.url,
-                'title': BACKREFERENCE_NAME
-            },
-        )
+    sync_remote_links(
+        jira, ticket, story,
+        link_hashes=link_hashes,
+        refresh_links=refresh_links,
+    )
 
     # Update the VersionOne ticket to store the JIRA Ticket number
     # we just created/updated.  This will ensure that we do not
@@ -504,3 +604,5 @@ def update_jira_ticket_with_versionone_data(
         webbrowser.open(
             ticket.permalink()
         )
+
+    return ticket
@@ -0,0 +1,319 @@
+import collections
+import logging
+import threading
+import time
+
+from .exceptions import ConfigurationError
+from .main import (
+    ensure_default_settings,
+    get_jira_connection,
+    get_jira_field_names,
+    get_jira_issue_for_v1_issue,
+    get_versionone_connection,
+    get_versionone_story_by_name,
+    update_jira_ticket_with_versionone_data,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+SyncResult = collections.namedtuple(
+    'SyncResult',
+    ['story_number', 'story', 'ticket', 'error', 'duration'],
+)
+
+
+class Reflector(object):
+    """ Long-lived owner of the VersionOne and JIRA connections.
+
+    Connecting to VersionOne and JIRA (including keyring lookups and,
+    if settings are missing, prompting the user) and fetching JIRA's
+    list of fields are done at most once per ``Reflector``; the results
+    are re-used for every story synchronized afterward.  This makes it
+    suitable for keeping alive inside of a long-running process::
+
+        reflector = Reflector(config, project='ABC')
+        for result in reflector.sync_iter(['B-01234', 'D-05678']):
+            if result.error:
+                ...
+
+    Connections are established lazily upon first use.  Each story is
+    synchronized while holding a lock so that a single instance may be
+    shared between threads, but stories from concurrent calls to
+    ``sync`` or ``sync_iter`` may be processed in any order relative to
+    one another.
+
+    New JIRA issues are created in ``project`` or, if that isn't set,
+    the configured ``jira.project``.  Set ``interactive`` to instead ask
+    the user which project to use each time an issue is created.
+
+    To avoid checking a ticket's links when its story's links haven't
+    changed since they were last synchronized, supply a dictionary-like
+    ``link_hashes`` store; it is keyed by JIRA issue key and is updated
+    as stories are synchronized, so persist it however you like (the
+    command line keeps it in the ``link_hashes`` section of the
+    configuration file).  Set ``refresh_links`` to check every ticket's
+    links anyway while still recording their new hashes.
+
+    If ``profile`` is set, it is used for keeping this instance's saved
+    passwords separate from those of other profiles; see
+    ``get_profile_configs``.
+
+    """
+    def __init__(
+        self, config, labels=None, open_url=False, project=None,
+        profile=None, interactive=False, link_hashes=None,
+        refresh_links=False,
+    ):
+        # Profiles' settings are never reset on upgrade; see
+        # ``get_profile_configs``.
+        self.config = ensure_default_settings(
+            config, upgrade=profile is None
+        )
+        self.profile = profile
+        self.labels = labels
+        self.open_url = open_url
+        self.project = project
+        self.interactive = interactive
+        self.link_hashes = link_hashes
+        self.refresh_links = refresh_links
+
+        self._v1 = None
+        self._jira = None
+        self._field_names = None
+        self._lock = threading.RLock()
+
+    @property
+    def v1(self):
+        if self._v1 is None:
+            self._v1 = get_versionone_connection(
+                self.config, profile=self.profile
+            )
+        return self._v1
+
+    @property
+    def jira(self):
+        if self._jira is None:
+            self._jira = get_jira_connection(
+                self.config, profile=self.profile
+            )
+        return self._jira
+
+    @property
+    def field_names(self):
+        """ JIRA custom field names, keyed by standardized name. """
+        if self._field_names is None:
+            self._field_names = get_jira_field_names(self.jira, self.config)
+        return self._field_names
+
+    def connect(self):
+        """ Establish connections and populate caches immediately. """
+        with self._lock:
+            self.v1
+            self.field_names
+        return self
+
+    def reset_caches(self):
+        """ Forget cached JIRA metadata and VersionOne asset data.
+
+        Connections are kept.
+
+        """
+        with self._lock:
+            self._field_names = None
+            self._clear_versionone_cache()
+
+    def _clear_versionone_cache(self):
+        # V1Meta keeps every asset it has loaded (and its attributes)
+        # in a cache that lives as long as the connection does; clear
+        # it so that changes made in VersionOne (to a story's links,
+        # for example) since the last synchronization are seen.
+        if self._v1 is not None:
+            self._v1.global_cache.clear()
+
+    def get_project(self, ticket):
+        """ Returns the project to create ``ticket`` in, if it is new.
+
+        Returns None if the user should be asked for a project instead.
+
+        """
+        if ticket is not None or self.project:
+            return self.project
+        if self.interactive:
+            return None
+        project = self.config['jira'].get('project')
+        if not project:
+            raise ConfigurationError(
+                "No JIRA project is configured for new issues."
+            )
+        return project
+
+    def sync_story(self, story_number):
+        """ Create or update the JIRA ticket for a single story.
+
+        Unlike ``sync_iter``, errors are raised rather than recorded.
+
+        """
+        with self._lock:
+            started = time.time()
+            logger.info("Processing story #%s", story_number)
+            self._clear_versionone_cache()
+            story = get_versionone_story_by_name(
+                self.v1, self.config, story_number
+            )
+            ticket = get_jira_issue_for_v1_issue(
+                self.jira, self.config, story
+            )
+            ticket = update_jira_ticket_with_versionone_data(
+                self.jira,
+                self.v1,
+                ticket,
+                story,
+                self.config,
+                self.labels,
+                open_url=self.open_url,
+                field_names=self.field_names,
+                project=self.get_project(ticket),
+                link_hashes=self.link_hashes,
+                refresh_links=self.refresh_links,
+            )
+            return SyncResult(
+                story_number, story, ticket, None, time.time() - started
+            )
+
+    def sync_iter(self, story_numbers):
+        """ Synchronize each story, yielding a ``SyncResult`` for each.
+
+        A failure to synchronize one story is logged and recorded on its
+        result's ``error`` attribute; processing continues with the next
+        story.
+
+        """
+        for story_number in story_numbers:
+            started = time.time()
+            try:
+                yield self.sync_story(story_number)
+            except Exception as e:
+                logger.exception(
+                    "Unable to synchronize story #%s", story_number
+                )
+                yield SyncResult(
+                    story_number, None, None, e, time.time() - started
+                )
+
+    def sync(self, story_numbers):
+        """ Synchronize each story; returns a list of ``SyncResult``s. """
+        return list(self.sync_iter(story_numbers))
+
+
+class SyncReport(object):
+    """ Aggregated results of synchronizing stories across profiles. """
+    def __init__(self):
+        self.results = collections.OrderedDict()
+        self.durations = collections.OrderedDict()
+
+    def add(self, profile, results, duration):
+        self.results[profile] = results
+        self.durations[profile] = duration
+
+    @property
+    def errors(self):
+        """ Returns a list of ``(profile, SyncResult)`` for each failure. """
+        return [
+            (profile, result)
+            for profile, results in self.results.items()
+            for result in results
+            if result.error
+        ]
+
+    @property
+    def metrics(self):
+        """ Returns per-profile counts and timings. """
+        metrics = collections.OrderedDict()
+        for profile, results in self.results.items():
+            failed = len([r for r in results if r.error])
+            metrics[profile] = {
+                'synced': len(results) - failed,
+                'failed': failed,
+                'duration': self.durations[profile],
+            }
+        return metrics
+
+    def log_summary(self):
+        for profile, values in self.metrics.items():
+            logger.info(
+                "Profile %s: %s synced, %s failed in %.2fs",
+                profile,
+                values['synced'],
+                values['failed'],
+                values['duration'],
+            )
+        for profile, result in self.errors:
+            logger.error(
+                "Profile %s: story #%s failed: %s",
+                profile,
+                result.story_number,
+                result.error,
+            )
+
+
+def sync_profiles(work):
+    """ Synchronize stories for several profiles concurrently.
+
+    ``work`` is a sequence of ``(reflector, story_numbers)`` pairs;
+    each reflector is run in its own thread using its own connections,
+    and a ``SyncReport`` covering all of them is returned once every
+    profile has finished.
+
+    """
+    report = SyncReport()
+    collected = {}
+
+    def run(reflector, story_numbers):
+        started = time.time()
+        results = None
+        try:
+            reflector.connect()
+        except Exception as e:
+            logger.exception(
+                "Unable to connect profile %s", reflector.profile
+            )
+            results = [
+                SyncResult(story_number, None, None, e, 0)
+                for story_number in story_numbers
+            ]
+        else:
+            results = reflector.sync(story_numbers)
+        finally:
+            if results is None:
+                # Something other than an Exception escaped; make sure
+                # this profile is still reported as having failed.
+                error = RuntimeError(
+                    "Synchronization of profile %s was interrupted." % (
+                        reflector.profile,
+                    )
+                )
+                results = [
+                    SyncResult(story_number, None, None, error, 0)
+                    for story_number in story_numbers
+                ]
+            collected[reflector.profile] = (
+                results, time.time() - started
+            )
+
+    threads = []
+    for reflector, story_numbers in work:
+        thread = threading.Thread(
+            target=run,
+            args=(reflector, story_numbers),
+            name='v1tojira-%s' % reflector.profile,
+        )
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    for reflector, _ in work:
+        report.add(reflector.profile, *collected[reflector.profile])
+    return report